@@ -36,6 +36,10 @@ setup(
     packages=find_packages(include=['sign_xpi_lib']),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        # Hardware accelerated CRC-32 for reading and writing XPIs
+        'zlib-ng': ['zlib-ng'],
+    },
     license="MPL",
     zip_safe=False,
     keywords='sign_xpi',
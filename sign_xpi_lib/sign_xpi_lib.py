@@ -5,22 +5,68 @@
 
 """Main module."""
 
-import fnmatch
+import binascii
+import copy
 import functools
 import hashlib
 import os.path
+import posixpath
+import queue
 import re
+import shutil
 import sys
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from zipfile import ZipFile, ZIP_DEFLATED
-from base64 import b64encode
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    pass
+else:
+    # zipfile computes a CRC-32 over every member it reads or writes.
+    # zlib-ng's implementation uses carry-less multiplication
+    # (PCLMULQDQ/VPCLMULQDQ, or the ARMv8 CRC instructions) and returns
+    # the same values as zlib's, only much faster.
+    zipfile.crc32 = zlib_ng.crc32
 
 
 directory_re = re.compile(r"[\\/]$")
+# Equivalent to matching the globs META-INF/manifest.mf, META-INF/*.sf,
+# META-INF/*.rsa, META-INF/*.dsa and META-INF/ids.json, in upper case
+ignored_metainf_re = re.compile(
+    r"META-INF/(MANIFEST\.MF|.*\.(SF|RSA|DSA)|IDS\.JSON)\Z", re.DOTALL)
 ZIPFILE_WRITE_EXCLUSIVE_MODE = 'x'
 ZIPFILE_WRITE_MODE = 'w'
 if sys.version_info >= (3, 5):
     ZIPFILE_WRITE_MODE = ZIPFILE_WRITE_EXCLUSIVE_MODE
 
+# Size of the reads used when hashing zip members
+CHUNK_SIZE = 256 * 1024
+# How many chunks may be read ahead of the ones being hashed
+PREFETCH_CHUNKS = 8
+# XPIs whose members add up to less than this many (uncompressed) bytes
+# are not worth starting read-ahead and hashing threads for
+_READ_AHEAD_THRESHOLD = 1024 * 1024
+# XPIs whose members add up to more than this many (uncompressed) bytes
+# get hashed by a pool of processes, if XPIFile is given max_workers
+_PARALLEL_THRESHOLD = 32 * 1024 * 1024
+
+# See file_key; everything else has priority 4
+file_priorities = {
+    'install.rdf': 1,
+    'chrome.manifest': 2,
+    'icon.png': 2,
+    'icon64.png': 2,
+    'MPL': 5,
+    'GPL': 5,
+    'LGPL': 5,
+    'COPYING': 5,
+    'LICENSE': 5,
+    'license.txt': 5,
+}
+
 
 def ignore_certain_metainf_files(filename):
     """
@@ -29,18 +75,9 @@ def ignore_certain_metainf_files(filename):
     on any given JAR.  This function returns True if the file name given is one
     that we dispose of to prevent multiple signatures.
     """
-    ignore = ("META-INF/manifest.mf",
-              "META-INF/*.sf",
-              "META-INF/*.rsa",
-              "META-INF/*.dsa",
-              "META-INF/ids.json")
-
-    for glob in ignore:
-        # Explicitly match against all upper case to prevent the kind of
-        # runtime errors that lead to https://bugzil.la/1169574
-        if fnmatch.fnmatchcase(filename.upper(), glob.upper()):
-            return True
-    return False
+    # Explicitly match against all upper case to prevent the kind of
+    # runtime errors that lead to https://bugzil.la/1169574
+    return ignored_metainf_re.match(filename.upper()) is not None
 
 
 def file_key(filename):
@@ -55,15 +92,10 @@ def file_key(filename):
     This order does not appear to affect anything in any way, but it
     looks nicer.
     '''
-    prio = 4
-    if filename == 'install.rdf':
-        prio = 1
-    elif filename in ["chrome.manifest", "icon.png", "icon64.png"]:
-        prio = 2
-    elif filename in ["MPL", "GPL", "LGPL", "COPYING",
-                      "LICENSE", "license.txt"]:
-        prio = 5
-    return (prio, os.path.split(filename.lower()))
+    prio = file_priorities.get(filename, 4)
+    # Zip member names always use forward slashes, whatever the platform
+    dirname, basename = posixpath.split(filename.lower())
+    return (prio, dirname, basename)
 
 
 def zinfo_key(zinfo):
@@ -73,33 +105,256 @@ def zinfo_key(zinfo):
     return file_key(zinfo.filename)
 
 
-def _digest(data):
-    md5 = hashlib.md5()
-    md5.update(data)
-    sha1 = hashlib.sha1()
-    sha1.update(data)
-    sha256 = hashlib.sha256()
-    sha256.update(data)
-    return {
-        'md5': md5.digest(),
-        'sha1': sha1.digest(),
-        'sha256': sha256.digest(),
-    }
+def _hash_constructor(name):
+    """Returns a callable which creates a new hash object for `name`.
+
+    hashlib's named constructors are backed by OpenSSL whenever it is
+    available, which is what gives us hardware accelerated hashing.
+    MD5 is only listed in the manifest for the benefit of old clients,
+    so tell hashlib it is not used for security; otherwise it is
+    unavailable in FIPS mode (only supported by Python 3.9+).
+    """
+    constructor = getattr(hashlib, name)
+    if name == 'md5':
+        try:
+            constructor(usedforsecurity=False)
+        except TypeError:
+            pass
+        else:
+            return functools.partial(constructor, usedforsecurity=False)
+    return constructor
+
+
+HASH_CONSTRUCTORS = {
+    algo: _hash_constructor(algo) for algo in ('md5', 'sha1', 'sha256')
+}
+# The digests put in manifests unless asked otherwise
+DEFAULT_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+
+def _new_hashes(algos):
+    return {algo: HASH_CONSTRUCTORS[algo]() for algo in algos}
+
+
+def _digest(data, algos=DEFAULT_ALGORITHMS):
+    hashes = _new_hashes(algos)
+    for h in hashes.values():
+        h.update(data)
+    return {algo: h.digest() for algo, h in hashes.items()}
+
+
+def _cpu_count():
+    """Returns the number of CPUs, or 1 if that is unknown."""
+    # FIXME: Take this out once we stop supporting 3.3
+    if sys.version_info < (3, 4):
+        return 1
+    return os.cpu_count() or 1
+
+
+def _member_chunks(zin, names):
+    """Yields the contents of the given members of `zin`.
+
+    Members are split in chunks of CHUNK_SIZE bytes, so the last chunk
+    of every member is shorter than that (possibly empty).
+    """
+    for name in names:
+        with zin.open(name) as fh:
+            while True:
+                chunk = fh.read(CHUNK_SIZE)
+                yield chunk
+                if len(chunk) < CHUNK_SIZE:
+                    break
+
+
+def _read_ahead(chunks, prefetched, stop):
+    """Moves `chunks` into the queue `prefetched` until `stop` is set.
+
+    If reading fails, the exception is put in the queue instead, so
+    that the consumer raises it rather than waiting forever.
+    """
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                break
+            prefetched.put(chunk)
+    except BaseException as e:
+        prefetched.put(e)
+    finally:
+        chunks.close()
+
+
+def _digest_chunks(next_chunk, algos, executor=None):
+    """Returns the digests of the next member from `next_chunk`.
+
+    hashlib releases the GIL while hashing large buffers, so if an
+    `executor` is given every algorithm is updated in its own thread.
+    """
+    hashes = _new_hashes(algos)
+    pending = []
+    while True:
+        chunk = next_chunk()
+        if isinstance(chunk, BaseException):
+            raise chunk
+        # Hash objects must see their chunks in order, so wait for the
+        # previous updates before starting on this one
+        for future in pending:
+            future.result()
+        if executor is None or len(chunk) < CHUNK_SIZE:
+            # Most members of an XPI fit in a single chunk; handing
+            # those to the executor would cost more than it saves.
+            for h in hashes.values():
+                h.update(chunk)
+        else:
+            pending = [executor.submit(h.update, chunk)
+                       for h in hashes.values()]
+        if len(chunk) < CHUNK_SIZE:
+            break
+    return {algo: h.digest() for algo, h in hashes.items()}
+
+
+def _digest_members(zin, names, algos, read_ahead=False):
+    """Returns the digests of the given members of the ZipFile `zin`.
+
+    With `read_ahead` and more than one CPU, the members are read and
+    decompressed on a separate thread, so that reading the next chunk
+    overlaps with hashing the current one. Nothing else may use `zin`
+    meanwhile.
+    """
+    chunks = _member_chunks(zin, names)
+    if not read_ahead or _cpu_count() == 1:
+        # There is nothing to overlap with on a single CPU
+        return [_digest_chunks(chunks.__next__, algos) for _ in names]
+
+    prefetched = queue.Queue(maxsize=PREFETCH_CHUNKS)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_ahead,
+                              args=(chunks, prefetched, stop))
+    reader.start()
+    try:
+        with ThreadPoolExecutor(max_workers=len(algos)) as executor:
+            return [_digest_chunks(prefetched.get, algos, executor)
+                    for _ in names]
+    finally:
+        stop.set()
+        # Make room in the queue in case the reader is waiting for it
+        try:
+            while True:
+                prefetched.get_nowait()
+        except queue.Empty:
+            pass
+        reader.join()
+
+
+def _digest_members_from_path(path, names, algos):
+    """Same as _digest_members, but for the XPI at `path`.
+
+    This opens its own handle on the archive so that it can be run in
+    a worker process. The other workers already keep the CPUs busy, so
+    no threads are started.
+    """
+    with ZipFile(path, 'r') as zin:
+        return _digest_members(zin, names, algos, read_ahead=False)
+
+
+def _digest_members_in_processes(path, zinfos, workers, algos):
+    """Same as _digest_members, but spreads the work over processes.
+
+    Every worker gets one batch of members, balanced by uncompressed
+    size, so that each process only has to parse the zip directory
+    once.
+    """
+    batches = [[] for _ in range(workers)]
+    loads = [0] * workers
+    by_size = sorted(range(len(zinfos)),
+                     key=lambda i: zinfos[i].file_size, reverse=True)
+    for i in by_size:
+        lightest = loads.index(min(loads))
+        batches[lightest].append(i)
+        loads[lightest] += zinfos[i].file_size
+
+    digests = [None] * len(zinfos)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            (batch, pool.submit(_digest_members_from_path, path,
+                                [zinfos[i].filename for i in batch], algos))
+            for batch in batches if batch
+        ]
+        for batch, future in futures:
+            for i, member_digests in zip(batch, future.result()):
+                digests[i] = member_digests
+    return digests
+
+
+def _copy_member(zin, zout, zinfo, compresslevel=None):
+    """Copies the member described by `zinfo` from `zin` to `zout`.
+
+    Where ZipFile.open() supports writing (Python 3.6+), the data is
+    streamed across in chunks instead of being read into memory.
+    """
+    # zout updates the ZipInfo it writes (offsets, sizes, flags), and
+    # zin's copy has to stay valid for reading
+    zinfo = copy.copy(zinfo)
+    if compresslevel is not None:
+        # Members written from a ZipInfo use its compression level
+        # rather than the one zout was opened with
+        zinfo._compresslevel = compresslevel
+    if sys.version_info < (3, 6):
+        zout.writestr(zinfo, zin.read(zinfo.filename))
+        return
+    with zin.open(zinfo) as src, zout.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def _digest_zinfos(zin, zinfos, algos, max_workers=None):
+    """Returns the digests of the members `zinfos` of the ZipFile `zin`.
+
+    Given `max_workers`, large XPIs on disk are hashed by a pool of up
+    to that many processes. Everything else is hashed in this process.
+    """
+    total_size = sum(f.file_size for f in zinfos)
+    # Worker processes reopen the XPI, so it has to be a file on disk
+    # rather than, say, a BytesIO
+    on_disk = isinstance(zin.filename, str) and os.path.isfile(zin.filename)
+    if (max_workers is not None and max_workers > 1
+            and total_size > _PARALLEL_THRESHOLD and on_disk):
+        return _digest_members_in_processes(zin.filename, zinfos,
+                                            max_workers, algos)
+    read_ahead = total_size > _READ_AHEAD_THRESHOLD
+    return _digest_members(zin, [f.filename for f in zinfos], algos,
+                           read_ahead)
+
+
+def _b64encode(data):
+    """Same as base64.b64encode, minus the handling of altchars."""
+    if sys.version_info >= (3, 6):
+        return binascii.b2a_base64(data, newline=False)
+    return binascii.b2a_base64(data)[:-1]
 
 
 class Section(object):
-    __slots__ = ('name', 'digests')
+    __slots__ = ('name', 'digests', '_bytes')
 
-    def __init__(self, name, digests={}):
+    def __init__(self, name, digests):
         self.name = name
         self.digests = digests
+        self._bytes = None
+
+    def __bytes__(self):
+        # Sections get serialized once for the manifest and again for
+        # every signature of it, so only do the work once
+        if self._bytes is None:
+            self._bytes = self._serialize()
+        return self._bytes
 
     def __str__(self):
+        return bytes(self).decode('utf-8')
+
+    def _serialize(self):
         # Important thing to note: placement of newlines in these strings is
         # sensitive and should not be changed without reading through
         # http://docs.oracle.com/javase/7/docs/technotes/guides/jar/jar.html#JAR%20Manifest
         # thoroughly.
-        entry = ''
+        #
         # The spec for zip files only supports extended ASCII and UTF-8
         # See http://www.pkware.com/documents/casestudies/APPNOTE.TXT
         # and search for "language encoding" for details
@@ -108,20 +363,16 @@ class Section(object):
         name = 'Name: {}'.format(self.name)
 
         # See https://bugzilla.mozilla.org/show_bug.cgi?id=841569#c35
-        while name:
-            entry += name[:72]
-            name = name[72:]
-            if name:
-                entry += '\n '
-        entry += '\n'
-        order = list(self.digests.keys())
-        order.sort()
-        entry += 'Digest-Algorithms: {}\n'.format(
-            ' '.join([algo.upper() for algo in order]))
-        for algo in order:
-            entry += '{}-Digest: {}\n'.format(
-                algo.upper(), b64encode(self.digests[algo]).decode('utf-8'))
-        return entry
+        name_lines = [name[i:i + 72] for i in range(0, len(name), 72)]
+        entry = bytearray('\n '.join(name_lines).encode('utf-8'))
+        entry += b'\n'
+        order = sorted(self.digests)
+        labels = [algo.upper().encode('ascii') for algo in order]
+        entry += b'Digest-Algorithms: ' + b' '.join(labels) + b'\n'
+        for algo, label in zip(order, labels):
+            entry += label + b'-Digest: '
+            entry += _b64encode(self.digests[algo]) + b'\n'
+        return bytes(entry)
 
 
 def manifest_header(type_name, version='1.0'):
@@ -156,12 +407,16 @@ class Manifest(object):
     def body(self):
         return "\n".join([str(i) for i in self.sections])
 
+    def to_bytes(self):
+        """Returns the manifest encoded as UTF-8, as it goes in the XPI."""
+        segments = [manifest_header('Manifest').encode('utf-8'),
+                    b"",
+                    b"\n".join([bytes(i) for i in self.sections]),
+                    b""]
+        return b"\n".join(segments)
+
     def __str__(self):
-        segments = [manifest_header('Manifest'),
-                    "",
-                    self.body,
-                    ""]
-        return "\n".join(segments)
+        return self.to_bytes().decode('utf-8')
 
 
 class Signature(object):
@@ -173,7 +428,7 @@ class Signature(object):
         return [
             "{}-Digest-Manifest: {}".format(
                 item[0].upper(),
-                b64encode(item[1]).decode('utf-8')
+                _b64encode(item[1]).decode('ascii')
             )
             for item in sorted(self.digest_manifests.items())
         ]
@@ -196,44 +451,110 @@ class XPIFile(object):
     to generate manifests such as would be found in a META-INF
     directory. These manifests can be signed, and this signature can
     be used to produce a signed XPI file.
+
+    The XPI stays open until close() is called, or until the end of
+    the with block when it is used as a context manager.
     """
 
-    def __init__(self, path, ids=None):
+    def __init__(self, path, ids=None, digest_cache=None,
+                 algos=DEFAULT_ALGORITHMS, max_workers=None):
         """
+        :param path: The XPI file to read.
+        :param ids: The contents of META-INF/ids.json, if any.
+        :param digest_cache: A mapping (such as a dict) in which member
+            digests are kept, keyed by name, CRC-32, size and `algos`,
+            so that members shared with previously read XPIs are not
+            hashed again. CRC-32 is easy to forge, so only share a cache
+            between XPIs that come from a trusted source.
+            (default: no cache)
+        :param algos: The digest algorithms to use in the manifest and
+            its signatures, any of "md5", "sha1" and "sha256". Hashing
+            fewer algorithms is faster, but older clients may need MD5
+            and SHA1. (default: all three)
+        :param max_workers: The number of processes which may be started
+            to hash XPIs whose members add up to more than 32 MiB.
+            Processes are forked (or spawned) from the caller, so leave
+            this unset where that is not safe. (default: hash everything
+            in this process)
         """
+        unknown = set(algos) - set(HASH_CONSTRUCTORS)
+        if not algos or unknown:
+            raise ValueError("Unsupported digest algorithms: {}".format(
+                ', '.join(sorted(unknown)) or '(none)'))
+        if max_workers is not None and max_workers < 1:
+            raise ValueError("max_workers must be greater than 0")
+        self.algos = tuple(sorted(algos))
         self.inpath = path
         self._digests = []
+        self._manifest = None
+        self._signatures = None
         self.ids = ids
-
-        def mksection(data, fname):
-            digests = _digest(data)
+        self._zin = ZipFile(self.inpath, 'r')
+        try:
+            self._scan(digest_cache, max_workers)
+        except BaseException:
+            self._zin.close()
+            raise
+
+    def _scan(self, digest_cache, max_workers):
+        def mksection(digests, fname):
             item = Section(fname, digests=digests)
             self._digests.append(item)
 
-        with ZipFile(self.inpath, 'r') as zin:
-            for f in sorted(zin.filelist, key=zinfo_key):
-                # Skip directories and specific files found in META-INF/ that
-                # are not permitted in the manifest
-                if (directory_re.search(f.filename)
-                        or ignore_certain_metainf_files(f.filename)):
-                    continue
-                mksection(zin.read(f.filename), f.filename)
-            if ids:
-                mksection(ids, 'META-INF/ids.json')
+        # Skip directories and specific files found in META-INF/ that
+        # are not permitted in the manifest
+        zinfos = [f for f in sorted(self._zin.filelist, key=zinfo_key)
+                  if not (directory_re.search(f.filename)
+                          or ignore_certain_metainf_files(f.filename))]
+
+        if digest_cache is None:
+            digests = _digest_zinfos(self._zin, zinfos, self.algos,
+                                     max_workers)
+        else:
+            keys = [(f.filename, f.CRC, f.file_size, self.algos)
+                    for f in zinfos]
+            digests = [digest_cache.get(key) for key in keys]
+            missing = [i for i, d in enumerate(digests) if d is None]
+            computed = _digest_zinfos(self._zin,
+                                      [zinfos[i] for i in missing],
+                                      self.algos, max_workers)
+            for i, member_digests in zip(missing, computed):
+                digests[i] = member_digests
+                digest_cache[keys[i]] = dict(member_digests)
+            # Sections must not share their digests with the cache (or
+            # with other XPIFiles using it)
+            digests = [dict(d) for d in digests]
+
+        for f, member_digests in zip(zinfos, digests):
+            mksection(member_digests, f.filename)
+        if self.ids:
+            mksection(_digest(self.ids, self.algos), 'META-INF/ids.json')
+
+    def close(self):
+        """Closes the underlying XPI file."""
+        self._zin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @property
-    @functools.lru_cache(maxsize=None)
     def manifest(self):
-        return Manifest(self._digests)
+        if self._manifest is None:
+            self._manifest = Manifest(self._digests)
+        return self._manifest
 
     @property
-    @functools.lru_cache(maxsize=None)
     def signatures(self):
-        # The META-INF/*.sf files should contain hashes of the individual
-        # sections of the the META-INF/manifest.mf file.  So we generate those
-        # signatures here
-        digest_manifest = _digest(str(self.manifest).encode('utf-8'))
-        return Signature(digest_manifests=digest_manifest)
+        if self._signatures is None:
+            # The META-INF/*.sf files should contain hashes of the individual
+            # sections of the the META-INF/manifest.mf file.  So we generate
+            # those signatures here
+            digest_manifest = _digest(self.manifest.to_bytes(), self.algos)
+            self._signatures = Signature(digest_manifests=digest_manifest)
+        return self._signatures
 
     @property
     def signature(self):
@@ -241,7 +562,15 @@ class XPIFile(object):
         # section signatures
         return self.signatures.header + "\n"
 
-    def make_signed(self, outpath, sigpath, signed_manifest, signature):
+    def make_signed(self, outpath, sigpath, signed_manifest, signature,
+                    compresslevel=None):
+        """Writes a signed copy of this XPI to `outpath`.
+
+        :param compresslevel: The zlib compression level (0-9) used for
+            the deflated members of the new XPI. Lower levels are faster
+            but produce a bigger file. Requires Python 3.7+.
+            (default: zlib's default level)
+        """
         if not outpath:
             raise IOError("No output file specified")
 
@@ -254,19 +583,23 @@ class XPIFile(object):
         sigpath = os.path.splitext(os.path.basename(sigpath))[0]
         sigpath = os.path.join('META-INF', sigpath)
 
-        with ZipFile(self.inpath, 'r') as zin:
-            with ZipFile(outpath, ZIPFILE_WRITE_MODE, ZIP_DEFLATED) as zout:
-                # The PKCS7 file("foo.rsa") *MUST* be the first file in the
-                # archive to take advantage of Firefox's optimized downloading
-                # of XPIs
-                zout.writestr("{}.rsa".format(sigpath), signature)
-                for f in zin.infolist():
-                    # Make sure we exclude any of our signature and manifest
-                    # files
-                    if ignore_certain_metainf_files(f.filename):
-                        continue
-                    zout.writestr(f, zin.read(f.filename))
-                zout.writestr("META-INF/manifest.mf", str(self.manifest))
-                zout.writestr("{}.sf".format(sigpath), signed_manifest)
-                if self.ids is not None:
-                    zout.writestr('META-INF/ids.json', self.ids)
+        zout_kwargs = {}
+        if compresslevel is not None:
+            zout_kwargs['compresslevel'] = compresslevel
+
+        with ZipFile(outpath, ZIPFILE_WRITE_MODE, ZIP_DEFLATED,
+                     **zout_kwargs) as zout:
+            # The PKCS7 file("foo.rsa") *MUST* be the first file in the
+            # archive to take advantage of Firefox's optimized downloading
+            # of XPIs
+            zout.writestr("{}.rsa".format(sigpath), signature)
+            for f in self._zin.infolist():
+                # Make sure we exclude any of our signature and manifest
+                # files
+                if ignore_certain_metainf_files(f.filename):
+                    continue
+                _copy_member(self._zin, zout, f, compresslevel)
+            zout.writestr("META-INF/manifest.mf", self.manifest.to_bytes())
+            zout.writestr("{}.sf".format(sigpath), signed_manifest)
+            if self.ids is not None:
+                zout.writestr('META-INF/ids.json', self.ids)
@@ -3,12 +3,19 @@
 
 """Tests for `sign_xpi_lib` package."""
 
+import hashlib
+import io
 import os.path
 import pytest
 import tempfile
-from zipfile import ZipFile
+import weakref
+import zipfile
+from zipfile import ZipFile, ZIP_DEFLATED
 
+import sign_xpi_lib
 from sign_xpi_lib import XPIFile
+from sign_xpi_lib.sign_xpi_lib import (
+    CHUNK_SIZE, file_key, ignore_certain_metainf_files)
 
 
 TEST_DIR, _ = os.path.split(__file__)
@@ -66,6 +73,11 @@ SHA256-Digest: hho3C/YNs59bdqjBl6JpcBtA5I4paeBb8wG/Dr7nUM4=
 """
 
 
+def test_xpi_signer_manifest_bytes_match_text():
+    x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))
+    assert x.manifest.to_bytes() == str(x.manifest).encode('utf-8')
+
+
 def test_xpi_signer_signature_seems_sane():
     """Verify that an XPI file's manifest is accessible and has stuff in it."""
     x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))
@@ -109,3 +121,203 @@ def test_xpi_signer_doesnt_overwrite_files():
             x.make_signed(signed_file,
                           'mozilla.rsa',
                           signed_manifest, signature)
+
+
+@pytest.mark.parametrize('cpu_count', [1, 2])
+def test_xpi_signer_digests_members_larger_than_a_chunk(monkeypatch,
+                                                        cpu_count):
+    monkeypatch.setattr(os, 'cpu_count', lambda: cpu_count)
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_READ_AHEAD_THRESHOLD', 0)
+    data = os.urandom(3 * CHUNK_SIZE + 17)
+    with tempfile.TemporaryDirectory() as sandbox:
+        xpi_file = os.path.join(sandbox, 'big-addon.xpi')
+        with ZipFile(xpi_file, 'w', ZIP_DEFLATED) as z:
+            z.writestr('big.bin', data)
+
+        x = XPIFile(xpi_file)
+        [section] = x.manifest.sections
+        assert section.name == 'big.bin'
+        assert section.digests == {
+            'md5': hashlib.md5(data).digest(),
+            'sha1': hashlib.sha1(data).digest(),
+            'sha256': hashlib.sha256(data).digest(),
+        }
+
+
+def test_xpi_signer_parallel_digests_match_serial(monkeypatch):
+    serial = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))
+
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_PARALLEL_THRESHOLD', 0)
+    parallel = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                       max_workers=3)
+
+    assert str(parallel.manifest) == str(serial.manifest)
+
+
+@pytest.mark.parametrize('filename,ignored', [
+    ('META-INF/manifest.mf', True),
+    ('meta-inf/MOZILLA.RSA', True),
+    ('META-INF/mozilla.sf', True),
+    ('META-INF/nested/cert.dsa', True),
+    ('META-INF/ids.json', True),
+    ('META-INF/mozilla.sfx', False),
+    ('META-INF/cose.sig', False),
+    ('chrome/META-INF/mozilla.rsa', False),
+    ('content.js', False),
+])
+def test_ignore_certain_metainf_files(filename, ignored):
+    assert ignore_certain_metainf_files(filename) is ignored
+
+
+def test_xpi_signer_make_signed_with_compresslevel():
+    data = b'hypothetical ' * 10000
+    with tempfile.TemporaryDirectory() as sandbox:
+        xpi_file = os.path.join(sandbox, 'addon.xpi')
+        with ZipFile(xpi_file, 'w', ZIP_DEFLATED) as z:
+            z.writestr('content.js', data)
+
+        sizes = {}
+        for level in (0, 9):
+            signed_file = os.path.join(sandbox, 'signed-{}.xpi'.format(level))
+            XPIFile(xpi_file).make_signed(signed_file, 'mozilla.rsa',
+                                          b'Signature-Version: 1.0-test',
+                                          b'This signature is valid',
+                                          compresslevel=level)
+            with ZipFile(signed_file, 'r') as z:
+                assert z.read('content.js') == data
+                sizes[level] = z.getinfo('content.js').compress_size
+        assert sizes[9] < sizes[0]
+
+
+def test_zipfile_uses_zlib_ng_crc32_when_available():
+    zlib_ng = pytest.importorskip('zlib_ng.zlib_ng')
+    assert zipfile.crc32 is zlib_ng.crc32
+
+
+def test_xpi_signer_reuses_cached_digests():
+    digest_cache = {}
+    x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                digest_cache=digest_cache)
+    assert len(digest_cache) == len(x.manifest.sections)
+
+    key = next(key for key in digest_cache if key[0] == 'content.js')
+    digest_cache[key] = {'sha1': b'cached'}
+    x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                digest_cache=digest_cache)
+    section = next(s for s in x.manifest.sections if s.name == 'content.js')
+    assert section.digests == {'sha1': b'cached'}
+    assert section.digests is not digest_cache[key]
+
+    section.digests['sha1'] = b'changed'
+    assert digest_cache[key] == {'sha1': b'cached'}
+
+
+def test_file_key_orders_manifest_entries():
+    filenames = ['LICENSE', 'b/a.js', 'install.rdf', 'Zed.js', 'a.js',
+                 'icon.png', 'c//b.js', '/abs.js', 'b/z.js']
+    assert sorted(filenames, key=file_key) == [
+        'install.rdf', 'icon.png', 'a.js', 'Zed.js', '/abs.js', 'b/a.js',
+        'b/z.js', 'c//b.js', 'LICENSE']
+    assert file_key('/abs.js') == (4, '/', 'abs.js')
+    assert file_key('c//b.js') == (4, 'c', 'b.js')
+
+
+def test_xpi_file_is_not_kept_alive_by_cached_properties():
+    x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))
+    assert x.manifest is x.manifest
+    assert x.signatures is x.signatures
+
+    ref = weakref.ref(x)
+    del x
+    assert ref() is None
+
+
+def test_xpi_signer_can_make_signed_twice_and_close():
+    signature = b'This signature is valid'
+    signed_manifest = b'Signature-Version: 1.0-test'
+    with ZipFile(get_test_file('hypothetical-addon-unsigned.xpi')) as z:
+        content = z.read('content.js')
+    with tempfile.TemporaryDirectory() as sandbox:
+        with XPIFile(get_test_file('hypothetical-addon-unsigned.xpi')) as x:
+            for name in ('first.xpi', 'second.xpi'):
+                signed_file = os.path.join(sandbox, name)
+                x.make_signed(signed_file, 'mozilla.rsa',
+                              signed_manifest, signature)
+                with ZipFile(signed_file, 'r') as z:
+                    assert z.testzip() is None
+                    assert z.read('content.js') == content
+
+        with pytest.raises(ValueError):
+            x.make_signed(os.path.join(sandbox, 'closed.xpi'), 'mozilla.rsa',
+                          signed_manifest, signature)
+
+
+@pytest.mark.parametrize('cpu_count', [1, 2])
+def test_xpi_signer_raises_on_corrupt_members(monkeypatch, cpu_count):
+    monkeypatch.setattr(os, 'cpu_count', lambda: cpu_count)
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_READ_AHEAD_THRESHOLD', 0)
+    with tempfile.TemporaryDirectory() as sandbox:
+        xpi_file = os.path.join(sandbox, 'corrupt-addon.xpi')
+        with ZipFile(xpi_file, 'w') as z:
+            z.writestr('a.js', b'a' * 100)
+            z.writestr('b.js', b'b' * 100)
+        with open(xpi_file, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'a' * 100))
+            f.write(b'x')
+
+        with pytest.raises(zipfile.BadZipFile):
+            XPIFile(xpi_file)
+
+
+def test_xpi_signer_with_only_sha256():
+    x = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                algos=('sha256',))
+    assert str(x.manifest).startswith("""Manifest-Version: 1.0
+
+Name: content.js
+Digest-Algorithms: SHA256
+SHA256-Digest: SyzN6k1xO7bMtWm4F0qmd9BQNII0Pdj9qAYt+31kwQ8=
+
+""")
+    assert x.signature.startswith("""Signature-Version: 1.0
+SHA256-Digest-Manifest: """)
+
+
+def test_xpi_signer_rejects_unknown_algorithms():
+    with pytest.raises(ValueError):
+        XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                algos=('sha256', 'crc32'))
+
+
+def test_xpi_signer_parallel_digests_of_file_objects(monkeypatch):
+    serial = XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))
+
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_PARALLEL_THRESHOLD', 0)
+    with open(get_test_file('hypothetical-addon-unsigned.xpi'), 'rb') as f:
+        xpi_data = io.BytesIO(f.read())
+    parallel = XPIFile(xpi_data, max_workers=3)
+
+    assert str(parallel.manifest) == str(serial.manifest)
+
+
+def test_xpi_signer_rejects_invalid_max_workers():
+    with pytest.raises(ValueError):
+        XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'),
+                max_workers=0)
+
+
+def test_xpi_signer_raises_when_reader_thread_dies(monkeypatch):
+    class ReaderDied(BaseException):
+        pass
+
+    def member_chunks(zin, names):
+        raise ReaderDied()
+        yield
+
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_READ_AHEAD_THRESHOLD', 0)
+    monkeypatch.setattr(sign_xpi_lib.sign_xpi_lib, '_member_chunks',
+                        member_chunks)
+    with pytest.raises(ReaderDied):
+        XPIFile(get_test_file('hypothetical-addon-unsigned.xpi'))